@@ -4,17 +4,22 @@ from jose import JWTError, jwt
 from passlib.context import CryptContext
 from sqlalchemy.orm import Session
 from datetime import datetime, timedelta, timezone
+import functools
+import os
+import time
 
 import models
-from database import get_db
+from database import SessionLocal
 
 # --- Configuration ---
 SECRET_KEY = "YOUR_SUPER_SECRET_KEY_GOES_HERE" # Change this!
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 # 1 day
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "10"))
+ADMIN_CACHE_TTL_SECONDS = 60
 
 # --- Hashing ---
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+pwd_context = CryptContext(schemes=["bcrypt"], bcrypt__rounds=BCRYPT_ROUNDS, deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 # --- Functions ---
@@ -47,7 +52,36 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def get_current_admin(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)) -> models.Admin:
+@functools.lru_cache(maxsize=64)
+def _get_admin_cached(username: str, bucket: int) -> models.Admin | None:
+    """Admin lookup cached per TTL bucket; `bucket` only serves as part of the cache key."""
+    db = SessionLocal()
+    try:
+        admin = db.query(models.Admin).filter(models.Admin.username == username).first()
+        if admin is not None:
+            db.expunge(admin)
+        return admin
+    finally:
+        db.close()
+
+def get_admin_by_username(username: str) -> models.Admin | None:
+    """Returns the admin row, served from a short-lived in-memory cache."""
+    return _get_admin_cached(username, int(time.time() // ADMIN_CACHE_TTL_SECONDS))
+
+def invalidate_admin_cache():
+    """Drops cached admin rows; call after any change to the admins table."""
+    _get_admin_cached.cache_clear()
+
+@functools.lru_cache(maxsize=256)
+def _verify_token(token: str) -> tuple[str | None, int]:
+    """
+    Verifies the JWT signature once per token and returns (username, exp).
+    Raises JWTError for invalid tokens (errors are not cached).
+    """
+    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    return payload.get("sub"), int(payload.get("exp", 0))
+
+def get_current_admin(token: str = Depends(oauth2_scheme)) -> models.Admin:
     """
     Dependency to get the current logged-in admin.
     This is used to protect endpoints.
@@ -58,14 +92,14 @@ def get_current_admin(token: str = Depends(oauth2_scheme), db: Session = Depends
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
+        username, exp = _verify_token(token)
     except JWTError:
         raise credentials_exception
+    # Cached entries outlive the token, so expiry is re-checked on every call
+    if username is None or exp <= time.time():
+        raise credentials_exception
     
-    admin = db.query(models.Admin).filter(models.Admin.username == username).first()
+    admin = get_admin_by_username(username)
     if admin is None:
         raise credentials_exception
     return admin
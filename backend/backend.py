@@ -1,15 +1,20 @@
 import uvicorn
-from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, Form, status, Body
+from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, Form, status, Body, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
 from sqlalchemy.orm import Session, joinedload
 from sqlalchemy.exc import IntegrityError
-import pickle
+from sqlalchemy import select, insert, case, literal
 import numpy as np
 import face_recognition
-from PIL import Image
-import io
-import pytz
+import cv2
+import os
+import gzip
+import asyncio
+import orjson
+import itertools
+from zoneinfo import ZoneInfo
 from datetime import datetime, time, timedelta
 from contextlib import asynccontextmanager
 
@@ -24,8 +29,117 @@ from models import EventType
 # --- Initialization ---
 # -------------------------------------------------------------------
 models.Base.metadata.create_all(bind=engine)
-IST = pytz.timezone("Asia/Kolkata")
+# create_all skips existing tables, so make sure newer indexes exist too
+for index in models.Attendance.__table__.indexes:
+    index.create(bind=engine, checkfirst=True)
+IST = ZoneInfo("Asia/Kolkata")
 KIOSK_CONTROL = {"command": "run"}  # in-memory kiosk control flag
+CLOCK_EVENT_COOLDOWN_SECONDS = 4  # per-user debounce for /api/clock_event
+
+EVENT_KEEPALIVE_SECONDS = 15
+# Open /api/events streams never finish on their own, so uvicorn must cancel them on
+# shutdown/reload instead of waiting for every kiosk to disconnect
+GRACEFUL_SHUTDOWN_SECONDS = 3
+
+# Pre-serialized kiosk encodings payload. "version" is bumped on register/update/delete;
+# "built" holds (version, body, gzipped body) and is rebuilt when the versions differ.
+_ENC_CACHE = {"version": 0, "built": (-1, b"", b"")}
+
+# Open /api/events streams as (event loop, queue) pairs
+_EVENT_SUBSCRIBERS = set()
+
+
+def publish_event(kind: str, data: dict):
+    """Push an event to every connected kiosk; safe to call from sync endpoints."""
+    for loop, queue in list(_EVENT_SUBSCRIBERS):
+        loop.call_soon_threadsafe(queue.put_nowait, (kind, data))
+
+
+def invalidate_encodings_cache():
+    """Mark the kiosk encodings cache stale and tell kiosks to reload."""
+    _ENC_CACHE["version"] += 1
+    publish_event("encodings", {})
+
+
+ENCODING_DIM = 128
+ENCODING_BYTES = ENCODING_DIM * 4  # float32
+
+
+def encoding_to_blob(encoding) -> bytes:
+    """Serialize a face encoding as raw little-endian float32 bytes."""
+    return np.ascontiguousarray(encoding, dtype="<f4").tobytes()
+
+
+def blob_to_encoding(blob: bytes) -> np.ndarray:
+    """Decode a raw float32 encoding blob (zero-copy view)."""
+    if len(blob) != ENCODING_BYTES:
+        raise ValueError(f"expected {ENCODING_BYTES}-byte float32 encoding, got {len(blob)} bytes")
+    return np.frombuffer(blob, dtype="<f4")
+
+
+def migrate_pickled_encodings():
+    """One-time migration of legacy pickled encodings to raw float32 bytes."""
+    import pickle
+
+    db = SessionLocal()
+    try:
+        migrated = 0
+        for u in db.query(models.User).all():
+            if len(u.encoding) == ENCODING_BYTES:
+                continue
+            try:
+                u.encoding = encoding_to_blob(pickle.loads(u.encoding))
+                migrated += 1
+            except Exception as e:
+                print(f"Encoding migration failed for {u.name}: {e}")
+        if migrated:
+            db.commit()
+            print(f"--- Migrated {migrated} pickled encodings to float32 ---")
+    finally:
+        db.close()
+
+
+def select_detection_model() -> str:
+    """Pick the face_locations model: FACE_DETECTION_MODEL=hog|cnn, or auto (cnn only with CUDA dlib)."""
+    requested = os.getenv("FACE_DETECTION_MODEL", "auto").lower()
+    if requested in ("hog", "cnn"):
+        return requested
+    try:
+        import dlib
+        if dlib.DLIB_USE_CUDA and dlib.cuda.get_num_devices() > 0:
+            return "cnn"
+    except Exception:
+        pass
+    return "hog"
+
+
+DETECTION_MODEL = select_detection_model()
+MAX_IMAGE_SIDE = 640  # uploads are downscaled to this before face detection
+
+
+def decode_upload_image(data: bytes) -> np.ndarray:
+    """Decode uploaded image bytes into an RGB array, downscaled to MAX_IMAGE_SIDE."""
+    bgr = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if bgr is None:
+        raise HTTPException(status_code=422, detail="Invalid image file.")
+    h, w = bgr.shape[:2]
+    scale = MAX_IMAGE_SIDE / max(h, w)
+    if scale < 1:
+        bgr = cv2.resize(bgr, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+
+
+def day_bounds_ist(d):
+    """Return [start, next_day_start) for an IST calendar date."""
+    start = datetime.combine(d, time.min, tzinfo=IST)
+    return start, start + timedelta(days=1)
+
+
+def as_ist(ts: datetime) -> datetime:
+    """Attach IST to a stored timestamp (SQLite returns IST wall-clock values naive)."""
+    if ts.tzinfo is None:
+        return ts.replace(tzinfo=IST)
+    return ts.astimezone(IST)
 
 
 def create_default_admin():
@@ -38,6 +152,7 @@ def create_default_admin():
             default_admin = models.Admin(username="admin", hashed_password=hashed_password)
             db.add(default_admin)
             db.commit()
+            auth.invalidate_admin_cache()
             print("--- Default admin user 'admin' created (password: password) ---")
         else:
             print("--- Admin user already exists ---")
@@ -49,6 +164,8 @@ def create_default_admin():
 async def lifespan(app: FastAPI):
     print("--- Server starting up ---")
     create_default_admin()
+    migrate_pickled_encodings()
+    print(f"--- Face detection model: {DETECTION_MODEL} ---")
     yield
     print("--- Server shutting down ---")
 
@@ -107,22 +224,22 @@ async def register_user(
 
     try:
         data = await file.read()
-        image = Image.open(io.BytesIO(data)).convert("RGB")
-        img_np = np.array(image)
+        img_np = decode_upload_image(data)
 
-        locations = face_recognition.face_locations(img_np, model="hog")
+        locations = face_recognition.face_locations(img_np, model=DETECTION_MODEL)
         if len(locations) == 0:
             raise HTTPException(status_code=422, detail="No face detected.")
         if len(locations) > 1:
             raise HTTPException(status_code=422, detail="Multiple faces detected.")
 
         encoding = face_recognition.face_encodings(img_np, locations)[0]
-        serialized = pickle.dumps(encoding)
+        serialized = encoding_to_blob(encoding)
 
         user = models.User(name=name, encoding=serialized)
         db.add(user)
         db.commit()
         db.refresh(user)
+        invalidate_encodings_cache()
         print(f"✅ Registered user: {user.name}")
         return user
     except HTTPException:
@@ -145,18 +262,34 @@ def list_users(
 # --- Kiosk Encodings & Control ---
 # -------------------------------------------------------------------
 @app.get("/api/encodings")
-def get_encodings(db: Session = Depends(get_db)):
-    """Provide known face encodings for kiosk."""
-    users = db.query(models.User).all()
-    names, encs = [], []
-    for u in users:
-        try:
-            enc = pickle.loads(u.encoding)
-            names.append(u.name)
-            encs.append(enc.tolist())
-        except Exception as e:
-            print(f"Encoding error for {u.name}: {e}")
-    return {"names": names, "encodings": encs}
+def get_encodings(request: Request, db: Session = Depends(get_db)):
+    """Provide known face encodings for kiosk (served from the in-memory cache)."""
+    built = _ENC_CACHE["built"]
+    if built[0] != _ENC_CACHE["version"]:
+        # Read the version before querying so a change committed mid-rebuild
+        # leaves the cache stale instead of being overwritten
+        version = _ENC_CACHE["version"]
+        users = db.query(models.User).all()
+        names, encs = [], []
+        for u in users:
+            try:
+                encs.append(blob_to_encoding(u.encoding))
+                names.append(u.name)
+            except Exception as e:
+                print(f"Encoding error for {u.name}: {e}")
+        matrix = np.stack(encs) if encs else []
+        body = orjson.dumps({"names": names, "encodings": matrix}, option=orjson.OPT_SERIALIZE_NUMPY)
+        built = (version, body, gzip.compress(body))
+        _ENC_CACHE["built"] = built
+
+    _, body, body_gzip = built
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        return Response(
+            content=body_gzip,
+            media_type="application/json",
+            headers={"Content-Encoding": "gzip", "Vary": "Accept-Encoding"},
+        )
+    return Response(content=body, media_type="application/json")
 
 
 @app.post("/api/clock_event", response_model=schemas.TodayAttendance)
@@ -167,47 +300,94 @@ def clock_event(name: str = Form(...), db: Session = Depends(get_db)):
         raise HTTPException(status_code=404, detail="User not found")
 
     now_ist = datetime.now(IST)
-    today_start = datetime.combine(now_ist.date(), time.min).astimezone(IST)
-    today_end = datetime.combine(now_ist.date(), time.max).astimezone(IST)
-
-    last = (
-        db.query(models.Attendance)
-        .filter(models.Attendance.user_id == user.id)
-        .filter(models.Attendance.timestamp >= today_start)
-        .filter(models.Attendance.timestamp <= today_end)
-        .order_by(models.Attendance.timestamp.desc())
-        .first()
+    today_start, today_end = day_bounds_ist(now_ist.date())
+
+    cutoff = now_ist - timedelta(seconds=CLOCK_EVENT_COOLDOWN_SECONDS)
+    att = models.Attendance
+
+    # Toggle from today's last event; decided inside the INSERT itself
+    last_type = (
+        select(att.event_type)
+        .where(att.user_id == user.id, att.timestamp >= today_start, att.timestamp < today_end)
+        .order_by(att.timestamp.desc())
+        .limit(1)
+        .scalar_subquery()
     )
-
-    new_type = EventType.CLOCK_IN
-    if last and last.event_type == EventType.CLOCK_IN:
-        new_type = EventType.CLOCK_OUT
-
-    new_record = models.Attendance(
-        user_id=user.id,
-        timestamp=now_ist,
-        event_type=new_type
+    new_type_expr = case(
+        (last_type == EventType.CLOCK_IN, literal(EventType.CLOCK_OUT, att.event_type.type)),
+        else_=literal(EventType.CLOCK_IN, att.event_type.type),
+    )
+    recent = select(att.id).where(att.user_id == user.id, att.timestamp > cutoff).exists()
+    stmt = (
+        insert(att)
+        .from_select(
+            ["user_id", "timestamp", "event_type"],
+            select(literal(user.id), literal(now_ist, att.timestamp.type), new_type_expr).where(~recent),
+        )
     )
 
+    # No RETURNING here: SQLite only supports it from 3.35
     try:
-        db.add(new_record)
+        result = db.execute(stmt)
+        new_type = None
+        if result.rowcount:
+            new_type = db.execute(
+                select(att.event_type).where(att.id == result.lastrowid)
+            ).scalar_one()
         db.commit()
-        print(f"✅ {name} marked {new_type} at {now_ist.strftime('%I:%M:%S %p')}")
-        return schemas.TodayAttendance(
-            name=user.name,
-            time=now_ist.strftime("%I:%M:%S %p"),
-            status=new_type
-        )
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=500, detail=f"Error marking attendance: {e}")
 
+    if new_type is None:
+        raise HTTPException(status_code=429, detail="Clock event already recorded moments ago")
+
+    print(f"✅ {name} marked {new_type} at {now_ist.strftime('%I:%M:%S %p')}")
+    return schemas.TodayAttendance(
+        name=user.name,
+        time=now_ist.strftime("%I:%M:%S %p"),
+        status=new_type
+    )
+
 
 
 
 # in backend.py, ensure KIOSK_CONTROL defined near top:
 KIOSK_CONTROL = {"command": "run"}  # possible values: run, pause, shutdown
 
+
+def format_sse(kind: str, data: dict) -> str:
+    return f"event: {kind}\ndata: {orjson.dumps(data).decode()}\n\n"
+
+
+@app.get("/api/events")
+async def kiosk_events():
+    """Server-sent events for the kiosk: `control` and `encodings` changes."""
+    async def event_stream():
+        # Registered here so the finally below always pairs with the add,
+        # even if the client drops before the stream starts
+        queue = asyncio.Queue()
+        subscriber = (asyncio.get_running_loop(), queue)
+        _EVENT_SUBSCRIBERS.add(subscriber)
+        try:
+            yield format_sse("control", dict(KIOSK_CONTROL))
+            while True:
+                try:
+                    kind, data = await asyncio.wait_for(queue.get(), timeout=EVENT_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield format_sse(kind, data)
+        finally:
+            _EVENT_SUBSCRIBERS.discard(subscriber)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
 # GET
 @app.get("/api/kiosk/control")
 def get_kiosk_control():
@@ -223,6 +403,7 @@ def post_kiosk_control(payload: dict = Body(...), admin: models.Admin = Depends(
     if cmd not in ("run", "pause", "shutdown"):
         raise HTTPException(status_code=400, detail="Invalid command. Use 'run', 'pause', or 'shutdown'.")
     KIOSK_CONTROL["command"] = cmd
+    publish_event("control", dict(KIOSK_CONTROL))
     print(f"Kiosk control updated -> {cmd}")
     return {"ok": True, "command": cmd}
 
@@ -240,14 +421,13 @@ def get_report(date_str: str, db: Session = Depends(get_db),
     except ValueError:
         raise HTTPException(status_code=422, detail="Invalid date format")
 
-    start = datetime.combine(date, time.min).astimezone(IST)
-    end = datetime.combine(date, time.max).astimezone(IST)
+    start, end = day_bounds_ist(date)
 
     recs = (
         db.query(models.Attendance)
         .options(joinedload(models.Attendance.user))
         .filter(models.Attendance.timestamp >= start)
-        .filter(models.Attendance.timestamp <= end)
+        .filter(models.Attendance.timestamp < end)
         .order_by(models.Attendance.timestamp.asc())
         .all()
     )
@@ -255,7 +435,7 @@ def get_report(date_str: str, db: Session = Depends(get_db),
     return [
         schemas.ReportEntry(
             name=r.user.name if r.user else "Unknown",
-            timestamp=r.timestamp.astimezone(IST),
+            timestamp=as_ist(r.timestamp),
             status=r.event_type
         )
         for r in recs if r.user
@@ -271,33 +451,25 @@ def get_total_hours(date_str: str, db: Session = Depends(get_db),
     except ValueError:
         raise HTTPException(status_code=422, detail="Invalid date format")
 
-    start = datetime.combine(date, time.min).astimezone(IST)
-    end = datetime.combine(date, time.max).astimezone(IST)
+    start, end = day_bounds_ist(date)
 
-    users = (
-        db.query(models.User)
-        .join(models.Attendance)
+    rows = (
+        db.query(models.Attendance)
+        .options(joinedload(models.Attendance.user))
         .filter(models.Attendance.timestamp >= start)
-        .filter(models.Attendance.timestamp <= end)
-        .distinct()
+        .filter(models.Attendance.timestamp < end)
+        .order_by(models.Attendance.user_id, models.Attendance.timestamp.asc())
         .all()
     )
 
     output = []
-    for u in users:
-        events = (
-            db.query(models.Attendance)
-            .filter(models.Attendance.user_id == u.id)
-            .filter(models.Attendance.timestamp >= start)
-            .filter(models.Attendance.timestamp <= end)
-            .order_by(models.Attendance.timestamp.asc())
-            .all()
-        )
-
+    for _, events in itertools.groupby(rows, key=lambda r: r.user_id):
         total = timedelta()
         last_in = None
         last_status = EventType.CLOCK_OUT
+        user = None
         for e in events:
+            user = e.user
             last_status = e.event_type
             if e.event_type == EventType.CLOCK_IN:
                 if not last_in:
@@ -307,10 +479,12 @@ def get_total_hours(date_str: str, db: Session = Depends(get_db),
                     total += e.timestamp - last_in
                     last_in = None
 
+        if user is None:
+            continue
         total_hrs = round(total.total_seconds() / 3600, 2)
         output.append(
             schemas.TotalHoursEntry(
-                name=u.name,
+                name=user.name,
                 total_hours=total_hrs,
                 status=last_status
             )
@@ -324,14 +498,13 @@ def get_today_attendance(db: Session = Depends(get_db),
                          admin: models.Admin = Depends(auth.get_current_active_admin)):
     """Return today's In/Out events."""
     now = datetime.now(IST)
-    start = datetime.combine(now.date(), time.min).astimezone(IST)
-    end = datetime.combine(now.date(), time.max).astimezone(IST)
+    start, end = day_bounds_ist(now.date())
 
     recs = (
         db.query(models.Attendance)
         .options(joinedload(models.Attendance.user))
         .filter(models.Attendance.timestamp >= start)
-        .filter(models.Attendance.timestamp <= end)
+        .filter(models.Attendance.timestamp < end)
         .order_by(models.Attendance.timestamp.desc())
         .all()
     )
@@ -339,7 +512,7 @@ def get_today_attendance(db: Session = Depends(get_db),
     return [
         schemas.TodayAttendance(
             name=r.user.name if r.user else "Unknown",
-            time=r.timestamp.astimezone(IST).strftime("%I:%M:%S %p"),
+            time=as_ist(r.timestamp).strftime("%I:%M:%S %p"),
             status=r.event_type
         )
         for r in recs if r.user
@@ -364,18 +537,18 @@ async def update_user(
 
         if file:
             data = await file.read()
-            img = Image.open(io.BytesIO(data)).convert("RGB")
-            np_img = np.array(img)
-            face_locs = face_recognition.face_locations(np_img, model="hog")
+            np_img = decode_upload_image(data)
+            face_locs = face_recognition.face_locations(np_img, model=DETECTION_MODEL)
             if len(face_locs) == 0:
                 raise HTTPException(status_code=422, detail="No face found in image.")
             if len(face_locs) > 1:
                 raise HTTPException(status_code=422, detail="Multiple faces detected.")
             encoding = face_recognition.face_encodings(np_img, face_locs)[0]
-            user.encoding = pickle.dumps(encoding)
+            user.encoding = encoding_to_blob(encoding)
 
         db.commit()
         db.refresh(user)
+        invalidate_encodings_cache()
         return user
 
     except HTTPException:
@@ -400,6 +573,7 @@ def delete_user(
     db.query(models.Attendance).filter(models.Attendance.user_id == user_id).delete()
     db.delete(user)
     db.commit()
+    invalidate_encodings_cache()
     print(f"🗑️ Deleted user: {user.name}")
     return {"message": f"User '{user.name}' removed successfully"}
 
@@ -408,4 +582,10 @@ def delete_user(
 # -------------------------------------------------------------------
 if __name__ == "__main__":
     print("Starting Face Recognition Attendance API V2.1 ...")
-    uvicorn.run("backend:app", host="127.0.0.1", port=8000, reload=True)
+    uvicorn.run(
+        "backend:app",
+        host="127.0.0.1",
+        port=8000,
+        reload=True,
+        timeout_graceful_shutdown=GRACEFUL_SHUTDOWN_SECONDS,
+    )
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, BLOB, ForeignKey, DateTime, Enum
+from sqlalchemy import Column, Integer, String, BLOB, ForeignKey, DateTime, Enum, Index
 from sqlalchemy.orm import relationship
 from database import Base
 import datetime
@@ -38,6 +38,12 @@ class Attendance(Base):
     REWRITTEN for In/Out logic.
     """
     __tablename__ = "attendance"
+    __table_args__ = (
+        # Per-user, per-day range scans in clock_event
+        Index("ix_att_user_ts", "user_id", "timestamp"),
+        # Whole-day range scans in the report / today endpoints
+        Index("ix_att_ts", "timestamp"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
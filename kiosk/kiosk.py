@@ -9,38 +9,68 @@ Updated logic:
  - Avoids duplicate IN/OUT calls within short intervals.
  - Works continuously without restart.
  - Responds to backend commands (pause / run / shutdown).
+ - Receives control/encoding changes via server-sent events, polling only as a fallback.
 """
 
 import cv2
 import face_recognition
 import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
 import threading
 import time
-import pytz
 import os
+import json
 from datetime import datetime
+from zoneinfo import ZoneInfo
 
 # ---------------- CONFIG ----------------
 API_URL = "http://127.0.0.1:8000"
 ENCODINGS_URL = f"{API_URL}/api/encodings"
 CLOCK_EVENT_URL = f"{API_URL}/api/clock_event"
 CONTROL_URL = f"{API_URL}/api/kiosk/control"
-IST = pytz.timezone("Asia/Kolkata")
+EVENTS_URL = f"{API_URL}/api/events"
+IST = ZoneInfo("Asia/Kolkata")
+# OpenCV YuNet face detector (download face_detection_yunet_2023mar.onnx from opencv_zoo);
+# falls back to dlib HOG when the model file is missing.
+YUNET_MODEL = os.getenv("YUNET_MODEL", os.path.join(os.path.dirname(os.path.abspath(__file__)), "face_detection_yunet_2023mar.onnx"))
+YUNET_SCORE_THRESHOLD = 0.8
+
+# Camera capture (MJPEG avoids per-frame YUYV conversion on most USB webcams)
+CAPTURE_WIDTH = 640
+CAPTURE_HEIGHT = 480
+CAPTURE_FPS = 15
+DETECT_WIDTH = 320              # frames are downscaled to this width for detection
+READ_RETRY_SECONDS = 0.05       # wait between failed frame reads
+MAX_READ_FAILURES = 20          # consecutive failed reads before reopening the camera
 
 # Detection thresholds
 MIN_DETECT_SECONDS = 10.0       # must be visible for 10 seconds to confirm presence (IN/OUT)
 COOLDOWN_SECONDS = 4.0          # cooldown to avoid instant re-toggles
-REFRESH_ENCODINGS_SECONDS = 300
+MATCH_THRESHOLD = 0.5           # max euclidean distance for a match
+COSINE_THRESHOLD = 1 - MATCH_THRESHOLD ** 2 / 2  # same cut-off for unit vectors (|a-b|^2 = 2 - 2cos)
+REFRESH_ENCODINGS_SECONDS = 300  # polling fallback while the event stream is down
 CONTROL_POLL_SECONDS = 3.0
+EVENTS_RETRY_SECONDS = 5.0
+MOTION_THRESHOLD = 2.0          # mean abs gray diff below which a frame is considered static
+STATIC_RECHECK_FRAMES = 10      # processed frames a static scene may skip detection
+UNRESOLVED_RECHECK_FRAMES = 3   # same, while no face or an "Unknown" face is shown
+LOCKED_ENCODE_SKIP_FRAMES = 15  # processed frames to reuse a locked name before re-encoding
 
 # Runtime state
-known_encodings = []
-known_names = []
-presence_state = {}
+# (matrix, names): matrix is (N, 128) contiguous with L2-normalized rows. Replaced as one
+# tuple by the event thread; the main loop reads it once per frame.
+known_faces = (np.empty((0, 128), dtype=np.float32), [])
+presence_state = {}  # main thread only
 last_encoding_refresh = 0.0
 paused = False
 shutdown_requested = False
+events_connected = False
+
+# Pooled keep-alive connections for all backend calls
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
 
 # ---------------- UTILITIES ----------------
 def log(msg):
@@ -60,36 +90,147 @@ def play_sound(success=True):
     except Exception:
         pass
 
+# ---------------- CAMERA ----------------
+def open_camera():
+    """Open the camera in MJPEG at the capture size; returns None if unavailable."""
+    cap = cv2.VideoCapture(0)
+    if not cap or not cap.isOpened():
+        return None
+    cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*"MJPG"))
+    cap.set(cv2.CAP_PROP_FRAME_WIDTH, CAPTURE_WIDTH)
+    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, CAPTURE_HEIGHT)
+    cap.set(cv2.CAP_PROP_FPS, CAPTURE_FPS)
+    return cap
+
+class Camera:
+    """Reads frames on a background thread, keeping only the newest one"""
+
+    def __init__(self):
+        self.frame = None
+        self.frame_id = 0
+        self.stopped = False
+        self.lock = threading.Lock()
+
+        # First open happens on the caller's (main) thread: on macOS, AVFoundation can
+        # only show the camera permission prompt from the main thread
+        cap = None
+        while cap is None:
+            cap = open_camera()
+            if cap is None:
+                log("⚠️ Camera not found. Retrying in 5s...")
+                time.sleep(5)
+        log("🎥 Camera initialized successfully.")
+
+        self.thread = threading.Thread(target=self._loop, args=(cap,), daemon=True)
+        self.thread.start()
+
+    def _loop(self, cap):
+        fail_count = 0
+        while not self.stopped:
+            if cap is None:
+                cap = open_camera()
+                if cap is None:
+                    log("⚠️ Camera not found. Retrying in 5s...")
+                    time.sleep(5)
+                    continue
+                log("🎥 Camera initialized successfully.")
+
+            ret, frame = cap.read()
+            if not ret:
+                # Transient read failures are common; only reopen the device after a streak
+                fail_count += 1
+                if fail_count > MAX_READ_FAILURES:
+                    log("⚠️ Camera read failed repeatedly. Reinitializing...")
+                    cap.release()
+                    cap = None
+                    fail_count = 0
+                    time.sleep(2)
+                else:
+                    time.sleep(READ_RETRY_SECONDS)
+                continue
+            fail_count = 0
+
+            with self.lock:
+                self.frame = frame
+                self.frame_id += 1
+
+        if cap is not None:
+            cap.release()
+
+    def read(self):
+        """Return (frame_id, frame) for the latest captured frame"""
+        with self.lock:
+            return self.frame_id, self.frame
+
+    def release(self):
+        self.stopped = True
+        self.thread.join(timeout=2)
+
+# ---------------- DETECTION ----------------
+def create_face_detector():
+    """Load the YuNet detector once; returns None to use HOG instead."""
+    if not os.path.exists(YUNET_MODEL):
+        log(f"⚠️ YuNet model not found at {YUNET_MODEL}. Using HOG detector.")
+        return None
+    try:
+        return cv2.FaceDetectorYN_create(YUNET_MODEL, "", (0, 0), YUNET_SCORE_THRESHOLD)
+    except Exception as e:
+        log(f"⚠️ Failed to load YuNet ({e}). Using HOG detector.")
+        return None
+
+def detect_faces(detector, bgr, rgb):
+    """Face boxes as (top, right, bottom, left) tuples, like face_recognition."""
+    if detector is None:
+        return face_recognition.face_locations(rgb, model="hog")
+    h, w = bgr.shape[:2]
+    detector.setInputSize((w, h))
+    _, faces = detector.detect(bgr)
+    if faces is None:
+        return []
+    locs = []
+    for x, y, fw, fh in faces[:, :4].astype(int):
+        top, left = max(y, 0), max(x, 0)
+        bottom, right = min(y + fh, h), min(x + fw, w)
+        if bottom > top and right > left:
+            locs.append((int(top), int(right), int(bottom), int(left)))
+    return locs
+
 # ---------------- BACKEND ----------------
 def load_encodings():
-    global known_encodings, known_names, last_encoding_refresh
+    global known_faces, last_encoding_refresh
     try:
-        r = requests.get(ENCODINGS_URL, timeout=8)
+        r = SESSION.get(ENCODINGS_URL, timeout=8)
         r.raise_for_status()
         data = safe_json(r)
-        known_names = data.get("names", [])
-        known_encodings = [np.array(e) for e in data.get("encodings", [])]
-
-        for n in known_names:
-            presence_state.setdefault(n, {
-                "detected_since": 0.0,
-                "last_seen": 0.0,
-                "present": False,
-                "last_marked": 0.0
-            })
+        encs = data.get("encodings", [])
+        matrix = np.asarray(encs, dtype=np.float32).reshape(len(encs), 128)
+        if len(matrix):
+            matrix = matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+        names = data.get("names", [])
+        known_faces = (np.ascontiguousarray(matrix), names)
 
         last_encoding_refresh = time.time()
-        log(f"✅ Loaded {len(known_names)} face encodings.")
+        log(f"✅ Loaded {len(names)} face encodings.")
         return True
     except Exception as e:
         log(f"❌ Failed to load encodings: {e}")
         return False
 
+def best_match(matrix, enc):
+    """Index of the most similar row of `matrix` above COSINE_THRESHOLD, or -1."""
+    if not len(matrix):
+        return -1
+    v = np.asarray(enc, dtype=np.float32)
+    v = v / np.linalg.norm(v)
+    scores = matrix @ v  # single sgemv over the normalized matrix
+    idx = int(np.argmax(scores))
+    return idx if scores[idx] > COSINE_THRESHOLD else -1
+
 def call_clock_event(name):
     """Send IN/OUT event to backend asynchronously"""
     def worker():
         try:
-            r = requests.post(CLOCK_EVENT_URL, data={"name": name}, timeout=8)
+            r = SESSION.post(CLOCK_EVENT_URL, data={"name": name}, timeout=8)
             r.raise_for_status()
             res = safe_json(r)
             log(f"📡 {name} -> {res.get('status')} at {res.get('time')}")
@@ -99,49 +240,111 @@ def call_clock_event(name):
             play_sound(False)
     threading.Thread(target=worker, daemon=True).start()
 
+def apply_control(cmd):
+    """Apply a control command received from the backend"""
+    global paused, shutdown_requested
+    cmd = (cmd or "").lower()
+    if cmd == "pause" and not paused:
+        paused = True
+        log("🟠 Terminal paused by admin.")
+    elif cmd == "run" and paused:
+        paused = False
+        log("🟢 Terminal resumed by admin.")
+    elif cmd == "shutdown":
+        shutdown_requested = True
+        log("🔴 Shutdown requested by admin.")
+
 def poll_control():
     """Poll backend for control command"""
-    global paused, shutdown_requested
     try:
-        r = requests.get(CONTROL_URL, timeout=4)
+        r = SESSION.get(CONTROL_URL, timeout=4)
         r.raise_for_status()
-        cmd = (safe_json(r).get("command") or "").lower()
-        if cmd == "pause" and not paused:
-            paused = True
-            log("🟠 Terminal paused by admin.")
-        elif cmd == "run" and paused:
-            paused = False
-            log("🟢 Terminal resumed by admin.")
-        elif cmd == "shutdown":
-            shutdown_requested = True
-            log("🔴 Shutdown requested by admin.")
+        apply_control(safe_json(r).get("command"))
     except Exception:
         pass
 
+def listen_events():
+    """Hold the backend event stream open and apply pushed changes"""
+    global events_connected
+    while not shutdown_requested:
+        try:
+            with SESSION.get(EVENTS_URL, stream=True, timeout=(5, 60)) as r:
+                r.raise_for_status()
+                events_connected = True
+                log("📶 Connected to backend event stream.")
+                load_encodings()  # catch up on anything missed while disconnected
+                kind = None
+                for line in r.iter_lines(decode_unicode=True):
+                    if shutdown_requested:
+                        return
+                    if line.startswith("event:"):
+                        kind = line[6:].strip()
+                    elif line.startswith("data:"):
+                        data = json.loads(line[5:])
+                        if kind == "control":
+                            apply_control(data.get("command"))
+                        elif kind == "encodings":
+                            load_encodings()
+                    elif not line:
+                        kind = None
+        except Exception as e:
+            log(f"⚠️ Event stream unavailable: {e}")
+        events_connected = False
+        time.sleep(EVENTS_RETRY_SECONDS)
+
+def update_presence(name, now_ts):
+    """Advance the IN/OUT state machine for a recognized user."""
+    state = presence_state.setdefault(name, {
+        "detected_since": 0.0,
+        "last_seen": 0.0,
+        "present": False,
+        "last_marked": 0.0
+    })
+
+    # Start tracking detection
+    if state["detected_since"] == 0.0:
+        state["detected_since"] = now_ts
+
+    state["last_seen"] = now_ts
+
+    # Require at least 10 seconds of continuous detection
+    if now_ts - state["detected_since"] >= MIN_DETECT_SECONDS:
+        if now_ts - state["last_marked"] >= COOLDOWN_SECONDS:
+            state["last_marked"] = now_ts
+            state["detected_since"] = 0.0
+
+            # Toggle IN/OUT
+            if not state["present"]:
+                state["present"] = True
+                log(f"🟩 {name} -> IN (appeared for 10s)")
+            else:
+                state["present"] = False
+                log(f"🟥 {name} -> OUT (reappeared for 10s)")
+
+            call_clock_event(name)
+
 # ---------------- MAIN ----------------
 def main():
     global last_encoding_refresh, paused, shutdown_requested
 
     log("🚀 Starting Face Recognition Terminal...")
+    detector = create_face_detector()
     load_encodings()
     last_encoding_refresh = time.time()
+    threading.Thread(target=listen_events, daemon=True).start()
 
-    cap = None
-    while True:
-        cap = cv2.VideoCapture(0)
-        if not cap or not cap.isOpened():
-            log("⚠️ Camera not found. Retrying in 5s...")
-            time.sleep(5)
-            continue
-        else:
-            log("🎥 Camera initialized successfully.")
-            break
+    camera = Camera()
 
     process_frame = True
+    last_frame_id = 0
     last_control_poll = 0.0
+    prev_gray = None
+    static_frames = 0
+    last_results = []   # [((top, right, bottom, left), name)] in full-frame coords
+    locked_frames = 0
 
     while True:
-        if time.time() - last_control_poll > CONTROL_POLL_SECONDS:
+        if not events_connected and time.time() - last_control_poll > CONTROL_POLL_SECONDS:
             poll_control()
             last_control_poll = time.time()
 
@@ -149,18 +352,16 @@ def main():
             log("🛑 Shutdown flag received. Exiting.")
             break
 
-        # refresh encodings every few minutes
-        if time.time() - last_encoding_refresh > REFRESH_ENCODINGS_SECONDS:
+        # refresh encodings every few minutes unless changes are being pushed
+        if not events_connected and time.time() - last_encoding_refresh > REFRESH_ENCODINGS_SECONDS:
             load_encodings()
             last_encoding_refresh = time.time()
 
-        ret, frame = cap.read()
-        if not ret:
-            log("⚠️ Camera read failed. Reinitializing...")
-            cap.release()
-            time.sleep(2)
-            cap = cv2.VideoCapture(0)
+        frame_id, frame = camera.read()
+        if frame_id == last_frame_id:
+            time.sleep(0.005)  # no new frame yet
             continue
+        last_frame_id = frame_id
 
         frame = cv2.flip(frame, 1)
         now_ts = time.time()
@@ -173,53 +374,65 @@ def main():
             continue
 
         if process_frame:
-            small = cv2.resize(frame, (0, 0), fx=0.25, fy=0.25)
-            rgb_small = cv2.cvtColor(small, cv2.COLOR_BGR2RGB)
-            face_locs = face_recognition.face_locations(rgb_small, model="hog")
-            face_encs = face_recognition.face_encodings(rgb_small, face_locs)
+            # One consistent snapshot; the event thread may swap known_faces at any time
+            known_matrix, known_names = known_faces
+            h, w = frame.shape[:2]
+            scale = max(w / DETECT_WIDTH, 1.0)
+            if scale > 1.0:
+                small = cv2.resize(frame, (DETECT_WIDTH, round(h / scale)), interpolation=cv2.INTER_AREA)
+            else:
+                small = frame
+            gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+            # prev_gray is the last frame detection ran on, so slow movement still accumulates
+            moving = (
+                prev_gray is None
+                or prev_gray.shape != gray.shape
+                or cv2.absdiff(prev_gray, gray).mean() >= MOTION_THRESHOLD
+            )
+            # Re-check a static scene periodically, sooner if nothing was recognized
+            unresolved = not last_results or any(name == "Unknown" for _, name in last_results)
+            recheck_after = UNRESOLVED_RECHECK_FRAMES if unresolved else STATIC_RECHECK_FRAMES
+            static_frames += 1
+
+            # Quiescent scene: keep the last results instead of re-running detection
+            if moving or static_frames >= recheck_after:
+                prev_gray = gray
+                static_frames = 0
+                # YuNet works on BGR, so only HOG needs the RGB copy up front
+                rgb_small = cv2.cvtColor(small, cv2.COLOR_BGR2RGB) if detector is None else None
+                face_locs = detect_faces(detector, small, rgb_small)
+
+                if not face_locs:
+                    # Nothing to encode
+                    names = []
+                    locked_frames = 0
+                elif locked_frames > 0 and len(face_locs) == 1 and len(last_results) == 1:
+                    # Same single known face: refresh its box, skip re-encoding
+                    names = [last_results[0][1]]
+                    locked_frames -= 1
+                else:
+                    if rgb_small is None:
+                        rgb_small = cv2.cvtColor(small, cv2.COLOR_BGR2RGB)
+                    # 5-point landmarks are enough to align a single frontal face
+                    face_encs = face_recognition.face_encodings(rgb_small, face_locs, num_jitters=1, model="small")
+                    names = []
+                    for enc in face_encs:
+                        idx = best_match(known_matrix, enc)
+                        names.append(known_names[idx] if idx >= 0 else "Unknown")
+                    locked = len(names) == 1 and names[0] != "Unknown"
+                    locked_frames = LOCKED_ENCODE_SKIP_FRAMES if locked else 0
+
+                last_results = [
+                    ((int(t * scale), int(r * scale), int(b * scale), int(l * scale)), name)
+                    for (t, r, b, l), name in zip(face_locs, names)
+                ]
 
             seen_names = set()
-
-            for (t, r, b, l), enc in zip(face_locs, face_encs):
-                name = "Unknown"
-                if known_encodings:
-                    dists = face_recognition.face_distance(known_encodings, enc)
-                    idx = int(np.argmin(dists))
-                    if dists[idx] < 0.5:
-                        name = known_names[idx]
-
-                top, right, bottom, left = t * 4, r * 4, b * 4, l * 4
-                color = (0, 255, 0) if name != "Unknown" else (0, 0, 255)
-                cv2.rectangle(frame, (left, top), (right, bottom), color, 2)
-                cv2.putText(frame, name, (left + 6, bottom - 8), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255, 255, 255), 2)
-
+            for _, name in last_results:
                 if name == "Unknown":
                     continue
-
                 seen_names.add(name)
-                state = presence_state[name]
-
-                # Start tracking detection
-                if state["detected_since"] == 0.0:
-                    state["detected_since"] = now_ts
-
-                state["last_seen"] = now_ts
-
-                # Require at least 10 seconds of continuous detection
-                if now_ts - state["detected_since"] >= MIN_DETECT_SECONDS:
-                    if now_ts - state["last_marked"] >= COOLDOWN_SECONDS:
-                        state["last_marked"] = now_ts
-                        state["detected_since"] = 0.0
-
-                        # Toggle IN/OUT
-                        if not state["present"]:
-                            state["present"] = True
-                            log(f"🟩 {name} -> IN (appeared for 10s)")
-                        else:
-                            state["present"] = False
-                            log(f"🟥 {name} -> OUT (reappeared for 10s)")
-
-                        call_clock_event(name)
+                update_presence(name, now_ts)
 
             # Reset detection streaks for unseen users
             for name, state in presence_state.items():
@@ -228,6 +441,11 @@ def main():
 
         process_frame = not process_frame
 
+        for (top, right, bottom, left), name in last_results:
+            color = (0, 255, 0) if name != "Unknown" else (0, 0, 255)
+            cv2.rectangle(frame, (left, top), (right, bottom), color, 2)
+            cv2.putText(frame, name, (left + 6, bottom - 8), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255, 255, 255), 2)
+
         now_str = datetime.now(IST).strftime("%A, %d %B %Y - %I:%M:%S %p")
         cv2.putText(frame, now_str, (20, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2)
 
@@ -236,7 +454,7 @@ def main():
             log("🧭 User exit via keyboard.")
             break
 
-    cap.release()
+    camera.release()
     cv2.destroyAllWindows()
     log("✅ Terminal stopped cleanly.")
 